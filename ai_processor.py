@@ -1,6 +1,13 @@
 import google.generativeai as genai
 import os
 import json
+import orjson
+import hashlib
+import functools
+import asyncio
+import threading
+import diskcache
+from cachetools import TTLCache
 
 class AIProcessorException(Exception):
     """Custom exception for AI processing errors."""
@@ -13,40 +20,137 @@ except Exception as e:
     # This is a critical error, so we raise our custom exception
     raise AIProcessorException(f"Error configuring Gemini API: {e}")
 
+# All async Gemini work runs on one long-lived event loop: the async client is created once per
+# process and its grpc.aio channel stays bound to the loop it was first used on.
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='gemini-event-loop', daemon=True).start()
+        return _loop
+
+# Caps the Gemini requests in flight across all analyses of the process
+_gemini_max_concurrency = 20
+_gemini_semaphore = None
+
+def configure_gemini_concurrency(max_concurrency):
+    """Sets how many Gemini requests may be in flight at once."""
+    global _gemini_max_concurrency, _gemini_semaphore
+    _gemini_max_concurrency = max_concurrency
+    _gemini_semaphore = None
+
+def gemini_semaphore():
+    """Returns the shared Gemini semaphore. Must be called on the shared event loop."""
+    global _gemini_semaphore
+    if _gemini_semaphore is None:
+        _gemini_semaphore = asyncio.Semaphore(_gemini_max_concurrency)
+    return _gemini_semaphore
+
+def run_async(coro):
+    """Runs a coroutine on the shared event loop from synchronous code and returns its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+# Cache for drug details: the same (drug, usage, disease) triple recurs across analyses
+DRUG_CACHE_TTL = 7 * 24 * 3600
+_drug_cache = TTLCache(maxsize=10_000, ttl=DRUG_CACHE_TTL)
+# TTLCache is not thread-safe, and analyses may run in several request threads at once
+_drug_cache_lock = threading.RLock()
+# Optional on-disk layer, enabled via configure_drug_cache(), so the cache survives restarts
+_persistent_drug_cache = None
+
+def configure_drug_cache(directory):
+    """Enables the persistent drug details cache stored in the given directory."""
+    global _persistent_drug_cache
+    _persistent_drug_cache = diskcache.Cache(directory)
+
+def _drug_cache_key(inn_protocol, usage_protocol, disease_context):
+    return hashlib.sha1(f"{inn_protocol}|{usage_protocol}|{disease_context}".encode()).hexdigest()
+
+def _get_cached_drug_details(key):
+    with _drug_cache_lock:
+        details = _drug_cache.get(key)
+    if details is None and _persistent_drug_cache is not None:
+        details = _persistent_drug_cache.get(key)
+        if details is not None:
+            with _drug_cache_lock:
+                _drug_cache[key] = details
+    # Ignore anything but a details dict (e.g. a list stored by an older version)
+    return details if isinstance(details, dict) else None
+
+def _cache_drug_details(key, details):
+    if not details or not isinstance(details, dict):
+        return
+    with _drug_cache_lock:
+        _drug_cache[key] = details
+    if _persistent_drug_cache is not None:
+        _persistent_drug_cache.set(key, details, expire=DRUG_CACHE_TTL)
+
+@functools.lru_cache(maxsize=1)
 def get_model():
-    """Initializes and returns the Gemini Pro model."""
+    """Initializes and returns the Gemini Pro model (built once per process)."""
     try:
         return genai.GenerativeModel('gemini-pro')
     except Exception as e:
         raise AIProcessorException(f"Could not initialize Gemini model: {e}")
 
+_json_decoder = json.JSONDecoder()
+
+def _find_json_start(text, pos):
+    """Returns the index of the next '{' or '[' at or after pos, or -1."""
+    starts = [i for i in (text.find('{', pos), text.find('[', pos)) if i != -1]
+    return min(starts) if starts else -1
+
+def _is_expected_json(value):
+    """Only JSON objects and non-empty arrays of objects count as an AI result (not e.g. a '[1]' footnote)."""
+    if isinstance(value, dict):
+        return True
+    return isinstance(value, list) and bool(value) and all(isinstance(item, dict) for item in value)
+
 def clean_json_from_response(text_response):
     """
-    Extracts a JSON object or array from a string response that might be wrapped in markdown.
+    Extracts the first JSON object (or array of objects) from a string response that might be wrapped in markdown or prose.
     Raises AIProcessorException if JSON is malformed or not found.
     """
-    json_start = text_response.find('{')
-    json_end = text_response.rfind('}') + 1
-    if json_start == -1 or json_end == 0:
-        json_start = text_response.find('[')
-        json_end = text_response.rfind(']') + 1
-        if json_start == -1 or json_end == 0:
-            raise AIProcessorException("No JSON object found in the AI response.")
-
-    json_str = text_response[json_start:json_end]
+    # Fast path: the response is a bare (or markdown-fenced) JSON document
+    candidate = text_response.strip()
+    if candidate.startswith('```'):
+        candidate = candidate.partition('\n')[2].rstrip()
+        if candidate.endswith('```'):
+            candidate = candidate[:-3]
     try:
-        return json.loads(json_str)
-    except json.JSONDecodeError as e:
-        error_message = f"Failed to decode JSON from AI response. Error: {e}. Response snippet: '{json_str[:100]}...'"
-        raise AIProcessorException(error_message)
+        value = orjson.loads(candidate)
+        if _is_expected_json(value):
+            return value
+    except orjson.JSONDecodeError:
+        pass # Surrounding prose or non-strict JSON (e.g. NaN); scan with the stdlib decoder below
 
-def analyze_document_context(full_text):
-    """
-    Performs the first AI call to get the overall disease context and a list of drugs.
-    Raises AIProcessorException on failure.
-    """
-    model = get_model()
-    prompt = f"""
+    # Decode in place from each candidate start; the first valid object (or array of objects) wins
+    last_error = None
+    start = _find_json_start(text_response, 0)
+    while start != -1:
+        try:
+            value = _json_decoder.raw_decode(text_response, start)[0]
+            if _is_expected_json(value):
+                return value
+        except json.JSONDecodeError as e:
+            last_error = e
+        start = _find_json_start(text_response, start + 1)
+
+    if last_error is None:
+        raise AIProcessorException("No JSON object found in the AI response.")
+    error_message = f"Failed to decode JSON from AI response. Error: {last_error}. Response snippet: '{text_response[:100]}...'"
+    raise AIProcessorException(error_message)
+
+# Token budget for the protocol text sent with a single document context call
+MAX_CONTEXT_TOKENS = 8000
+
+def _build_document_context_prompt(text):
+    """Builds the prompt for the first AI call (disease context and drug list)."""
+    return f"""
     Проанализируй следующий текст клинического протокола. Твоя задача — выполнить две вещи:
     1. Определи основное заболевание или клинический контекст, описанный в протоколе.
     2. Извлеки ВСЕ лекарственные препараты, упомянутые в тексте, вместе с их способом применения и уровнем доказательности (если указан).
@@ -65,25 +169,88 @@ def analyze_document_context(full_text):
 
     Вот текст для анализа:
     ---
-    {full_text[:15000]}
+    {text}
     ---
     """
-    try:
-        response = model.generate_content(prompt)
-        # The response object has a prompt_feedback attribute that can be checked for safety ratings
+
+def _split_into_chunks(text, max_chars):
+    """Splits text on paragraph boundaries into chunks of at most max_chars characters."""
+    chunks, current, size = [], [], 0
+    for paragraph in text.split('\n'):
+        # A paragraph longer than a whole chunk is cut into pieces of its own
+        pieces = [paragraph[i:i + max_chars] for i in range(0, len(paragraph), max_chars)] or ['']
+        for piece in pieces:
+            if current and size + len(piece) + 1 > max_chars:
+                chunks.append('\n'.join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 1
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+def normalized_drug_key(drug):
+    """Key under which drug list entries with the same name and usage are considered duplicates."""
+    return (str(drug.get('inn_protocol') or '').strip().lower(), str(drug.get('usage_protocol') or '').strip().lower())
+
+def _merge_document_contexts(results):
+    """
+    Merges per-chunk results: the first non-empty disease context, and all drugs.
+    Only exact duplicates (seen by overlapping chunks) are dropped; rows for the same drug
+    with different fields, e.g. another loe_protocol, are kept and grouped later by the caller.
+    """
+    disease_context = next((r.get('disease_context') for r in results if r.get('disease_context')), None)
+    drug_list = []
+    for result in results:
+        for drug in result.get('drug_list') or []:
+            if drug not in drug_list:
+                drug_list.append(drug)
+    return {'disease_context': disease_context, 'drug_list': drug_list}
+
+async def _analyze_document_chunks_async(model, chunks):
+    async def analyze_chunk(chunk):
+        response = await _generate_content_async(model, _build_document_context_prompt(chunk), gemini_semaphore())
         if response.prompt_feedback.block_reason:
             raise AIProcessorException(f"AI call blocked due to: {response.prompt_feedback.block_reason.name}")
-        return clean_json_from_response(response.text)
-    except Exception as e:
-        raise AIProcessorException(f"Gemini API call for document context failed: {e}")
+        result = clean_json_from_response(response.text)
+        if not isinstance(result, dict):
+            raise AIProcessorException("AI response for a document chunk is not a JSON object.")
+        return result
 
-def get_drug_details(inn_protocol, usage_protocol, disease_context):
+    return await asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks))
+
+def analyze_document_context(full_text):
     """
-    Performs the second AI call to get detailed information for a single drug.
+    Performs the first AI call to get the overall disease context and a list of drugs.
+    Texts over MAX_CONTEXT_TOKENS are split on paragraph boundaries and analyzed chunk by chunk
+    (concurrently), then the results are merged.
     Raises AIProcessorException on failure.
     """
     model = get_model()
-    prompt = f"""
+    try:
+        # A token is never shorter than one character, so short texts need no count
+        if len(full_text) <= MAX_CONTEXT_TOKENS:
+            total_tokens = len(full_text)
+        else:
+            total_tokens = model.count_tokens(full_text).total_tokens
+
+        if total_tokens <= MAX_CONTEXT_TOKENS:
+            response = model.generate_content(_build_document_context_prompt(full_text))
+            # The response object has a prompt_feedback attribute that can be checked for safety ratings
+            if response.prompt_feedback.block_reason:
+                raise AIProcessorException(f"AI call blocked due to: {response.prompt_feedback.block_reason.name}")
+            return clean_json_from_response(response.text)
+
+        # Size chunks with this document's own characters-per-token ratio, keeping a 10% margin
+        max_chars = max(1, int(len(full_text) * MAX_CONTEXT_TOKENS / total_tokens * 0.9))
+        chunks = _split_into_chunks(full_text, max_chars)
+        return _merge_document_contexts(run_async(_analyze_document_chunks_async(model, chunks)))
+    except Exception as e:
+        raise AIProcessorException(f"Gemini API call for document context failed: {e}")
+
+def _build_drug_details_prompt(inn_protocol, usage_protocol, disease_context):
+    """Builds the prompt for the second AI call (details for a single drug)."""
+    return f"""
     Проанализируй следующий препарат в контексте заболевания "{disease_context}".
 
     Препарат: {inn_protocol}
@@ -101,10 +268,125 @@ def get_drug_details(inn_protocol, usage_protocol, disease_context):
     - brief_description: Очень краткое (1-2 предложения) описание роли этого препарата в лечении указанного заболевания.
     - system_loe: Твоя оценка уровня доказательности препарата для данного показания (например, "Класс I (A)", "Класс IIb (B)"), основанная на твоих общих знаниях.
     """
+
+def get_drug_details(inn_protocol, usage_protocol, disease_context):
+    """
+    Performs the second AI call to get detailed information for a single drug.
+    Synchronous wrapper around get_drug_details_async. Raises AIProcessorException on failure.
+    """
+    return run_async(get_drug_details_async(inn_protocol, usage_protocol, disease_context))
+
+def _as_drug_details(value):
+    """Returns the details object from a parsed AI reply, unwrapping a one-element list. Raises AIProcessorException otherwise."""
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    if not isinstance(value, dict):
+        raise AIProcessorException(f"Expected a JSON object with drug details, got: {str(value)[:100]}")
+    return value
+
+async def _generate_content_async(model, prompt, semaphore=None):
+    if semaphore is None:
+        return await model.generate_content_async(prompt)
+    async with semaphore:
+        return await model.generate_content_async(prompt)
+
+async def get_drug_details_async(inn_protocol, usage_protocol, disease_context, semaphore=None):
+    """
+    Gets detailed information for a single drug; async, so that calls for many drugs can be issued concurrently.
+    An optional asyncio.Semaphore caps the number of requests in flight.
+    Raises AIProcessorException on failure.
+    """
+    key = _drug_cache_key(inn_protocol, usage_protocol, disease_context)
+    cached = _get_cached_drug_details(key)
+    if cached is not None:
+        return cached
+
+    model = get_model()
+    prompt = _build_drug_details_prompt(inn_protocol, usage_protocol, disease_context)
     try:
-        response = model.generate_content(prompt)
+        response = await _generate_content_async(model, prompt, semaphore)
         if response.prompt_feedback.block_reason:
             raise AIProcessorException(f"AI call blocked for drug '{inn_protocol}' due to: {response.prompt_feedback.block_reason.name}")
-        return clean_json_from_response(response.text)
+        details = _as_drug_details(clean_json_from_response(response.text))
+        _cache_drug_details(key, details)
+        return details
     except Exception as e:
         raise AIProcessorException(f"Gemini API call for drug details failed for '{inn_protocol}': {e}")
+
+def _build_drug_details_batch_prompt(drug_tuples, disease_context):
+    """Builds one prompt asking for the details of several drugs at once."""
+    drug_lines = "\n".join(
+        f"    {i}. Препарат: {inn_protocol}; Способ применения: {usage_protocol}"
+        for i, (inn_protocol, usage_protocol) in enumerate(drug_tuples, start=1)
+    )
+    return f"""
+    Проанализируй следующие препараты в контексте заболевания "{disease_context}".
+
+{drug_lines}
+
+    Верни результат в виде ОДНОГО JSON-объекта со следующей структурой, по одному элементу на каждый препарат, в том же порядке:
+    {{
+      "drugs": [
+        {{
+          "index": 1,
+          "inn_protocol": "...",
+          "inn_english": "...",
+          "brief_description": "...",
+          "system_loe": "..."
+        }}
+      ]
+    }}
+
+    Пояснения к полям:
+    - index: Номер препарата из списка выше.
+    - inn_protocol: Название препарата точно в том виде, как оно указано в списке выше.
+    - inn_english: Международное непатентованное наименование (МНН) на английском языке.
+    - brief_description: Очень краткое (1-2 предложения) описание роли этого препарата в лечении указанного заболевания.
+    - system_loe: Твоя оценка уровня доказательности препарата для данного показания (например, "Класс I (A)", "Класс IIb (B)"), основанная на твоих общих знаниях.
+    """
+
+async def get_drug_details_batch_async(drug_tuples, disease_context, semaphore=None):
+    """
+    Gets details for several (inn_protocol, usage_protocol) pairs with a single AI call.
+    Cached drugs are left out of the prompt. Returns a list aligned with drug_tuples;
+    drugs the AI response does not unambiguously answer are None, so the caller can retry them individually.
+    Raises AIProcessorException on failure.
+    """
+    keys = [_drug_cache_key(inn, usage, disease_context) for inn, usage in drug_tuples]
+    results = [_get_cached_drug_details(key) for key in keys]
+    missing = [i for i, details in enumerate(results) if details is None]
+    if not missing:
+        return results
+
+    model = get_model()
+    prompt = _build_drug_details_batch_prompt([drug_tuples[i] for i in missing], disease_context)
+    try:
+        response = await _generate_content_async(model, prompt, semaphore)
+        if response.prompt_feedback.block_reason:
+            raise AIProcessorException(f"AI call blocked for drug batch due to: {response.prompt_feedback.block_reason.name}")
+        batch = clean_json_from_response(response.text)
+    except Exception as e:
+        raise AIProcessorException(f"Gemini API call for drug details failed for batch of {len(missing)} drugs: {e}")
+
+    items = batch.get('drugs') if isinstance(batch, dict) else batch
+    if not isinstance(items, list):
+        raise AIProcessorException("AI response for drug batch does not contain a drug list.")
+    # Map items back by their echoed index only: guessing from positions would shift every later
+    # answer onto the wrong drug when one is skipped. Indexes claimed more than once are dropped.
+    by_index = {}
+    for item in items:
+        index = item.get('index') if isinstance(item, dict) else None
+        if isinstance(index, int) and not isinstance(index, bool) and 1 <= index <= len(missing):
+            by_index[index] = None if index in by_index else item
+    for index, item in by_index.items():
+        if item is None:
+            continue
+        i = missing[index - 1]
+        # If the AI echoed the drug name, it must match the drug at that index
+        echoed_inn = item.pop('inn_protocol', None)
+        item.pop('index')
+        if echoed_inn is not None and str(echoed_inn).strip().lower() != str(drug_tuples[i][0] or '').strip().lower():
+            continue
+        results[i] = item
+        _cache_drug_details(keys[i], item)
+    return results
@@ -1,17 +1,36 @@
 import os
-import re
 import io
-import docx
-import requests
-from flask import Flask, render_template, request, redirect, url_for, flash
+import atexit
+import asyncio
+import threading
+import zipfile
+import aiohttp
+import diskcache
+import orjson
+from cachetools import TTLCache
+from lxml import etree
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file
 from werkzeug.utils import secure_filename
 from flask_migrate import Migrate
+from sqlalchemy.orm import selectinload
 
 from config import Config
 from extensions import db
 from models import Analysis, DrugResult
 from ai_processor import AIProcessorException
 import ai_processor
+import report_exporter
+
+# WordprocessingML tags used when streaming word/document.xml
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+W_BODY, W_P, W_TBL, W_TR, W_TC, W_R, W_T, W_BR = (W_NS + tag for tag in ('body', 'p', 'tbl', 'tr', 'tc', 'r', 't', 'br'))
+W_TYPE = W_NS + 'type'
+# Other run children that stand for a character, as in python-docx's run.text
+W_RUN_CHARS = {W_NS + 'tab': '\t', W_NS + 'ptab': '\t', W_NS + 'cr': '\n', W_NS + 'noBreakHyphen': '-'}
+
+# PubMed responses that are worth retrying, and the base delay (seconds) between attempts
+PUBMED_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+PUBMED_RETRY_BACKOFF = 0.3
 
 def create_app(config_class=Config):
     app = Flask(__name__)
@@ -22,43 +41,206 @@ def create_app(config_class=Config):
 
     with app.app_context():
         try:
-            os.makedirs(app.instance_path)
+            os.makedirs(app.instance_path, exist_ok=True)
             os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
         except OSError:
             pass
 
+    ai_processor.configure_drug_cache(os.path.join(app.instance_path, 'drug_cache'))
+    ai_processor.configure_gemini_concurrency(app.config['GEMINI_MAX_CONCURRENCY'])
+
+    # PubMed results cache: in-memory, backed by an on-disk store that survives restarts
+    pubmed_cache = TTLCache(maxsize=20_000, ttl=app.config['PUBMED_CACHE_TTL'])
+    pubmed_cache_lock = threading.RLock() # TTLCache is not thread-safe
+    pubmed_disk_cache = diskcache.Cache(os.path.join(app.instance_path, 'pubmed_cache'))
+    # Rendered .docx reports; an analysis never changes after upload, so entries need no expiry
+    export_cache = diskcache.Cache(os.path.join(app.instance_path, 'exports'))
+    # PubMed limits and the HTTP session shared by all analyses; created lazily on the shared event loop
+    pubmed_semaphore = None
+    pubmed_next_request = 0.0
+    http_session = None
+
     # --- Helper Functions ---
+    allowed_extensions = app.config['ALLOWED_EXTENSIONS']
+    allowed_mimetype = app.config['ALLOWED_MIMETYPE']
+
     def allowed_file(file):
-        return file.filename and '.' in file.filename and \
-               file.filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS'] and \
-               file.mimetype == app.config['ALLOWED_MIMETYPE']
+        filename = file.filename or ''
+        dot = filename.rfind('.')
+        ext = filename[dot + 1:].lower() if dot != -1 else ''
+        # Cheap extension check first; the MIME type is only compared for plausible files
+        return ext in allowed_extensions and file.mimetype == allowed_mimetype
+
+    def get_full_text_from_docx(docx_file):
+        """
+        Extracts all paragraphs and table rows from a .docx file (path or file-like object) into a single string.
+        Streams word/document.xml directly instead of building the python-docx object model.
+        """
+        def paragraph_text(p):
+            parts = []
+            for run in p.iter(W_R):
+                for child in run:
+                    if child.tag == W_T:
+                        parts.append(child.text or '')
+                        # Unexpanded entity references are child nodes; keep the text that follows them
+                        parts.extend(node.tail or '' for node in child)
+                    elif child.tag == W_BR:
+                        # Only line breaks become text; page and column breaks do not
+                        if child.get(W_TYPE, 'textWrapping') == 'textWrapping':
+                            parts.append('\n')
+                    else:
+                        parts.append(W_RUN_CHARS.get(child.tag, ''))
+            return ''.join(parts)
 
-    def get_full_text_from_docx(filepath):
-        """Extracts all paragraphs from a .docx file into a single string."""
         try:
-            document = docx.Document(filepath)
-            return "\n".join([para.text for para in document.paragraphs])
+            lines = []
+            with zipfile.ZipFile(docx_file) as archive, archive.open('word/document.xml') as xml_stream:
+                # Uploaded XML is untrusted: never expand entities or fetch anything over the network
+                events = etree.iterparse(xml_stream, events=('end',), tag=(W_P, W_TBL), resolve_entities=False, no_network=True)
+                for _, elem in events:
+                    if elem.getparent().tag != W_BODY:
+                        continue # Paragraphs inside tables are read together with their table
+                    if elem.tag == W_P:
+                        lines.append(paragraph_text(elem))
+                    else:
+                        for row in elem.iterchildren(W_TR):
+                            cells = (" ".join(paragraph_text(p) for p in cell.iter(W_P)) for cell in row.iterchildren(W_TC))
+                            lines.append("\t".join(cells))
+                    # Drop the element and the already processed siblings so memory stays flat
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+            return "\n".join(lines)
         except Exception as e:
             print(f"Error reading docx file: {e}")
             return None
 
-    def query_pubmed(drug_name, disease):
+    def save_upload(filepath, data):
+        try:
+            with open(filepath, 'wb') as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Could not save uploaded file: {e}")
+
+    def get_http_session():
+        """
+        Returns the pooled HTTP session shared by all analyses, so keep-alive TCP/TLS connections
+        to PubMed are reused across uploads. Must be called on the shared event loop.
+        """
+        nonlocal http_session
+        if http_session is None:
+            connector = aiohttp.TCPConnector(limit=app.config['HTTP_POOL_SIZE'], keepalive_timeout=30, ttl_dns_cache=300)
+            # Without a timeout a stalled PubMed connection would hang the whole analysis
+            timeout = aiohttp.ClientTimeout(total=app.config['PUBMED_TIMEOUT'], sock_connect=3.05)
+            http_session = aiohttp.ClientSession(connector=connector, timeout=timeout, trust_env=True)
+            atexit.register(lambda: ai_processor.run_async(http_session.close()))
+        return http_session
+
+    def get_pubmed_semaphore():
+        """Returns the shared PubMed semaphore. Must be called on the shared event loop."""
+        nonlocal pubmed_semaphore
+        if pubmed_semaphore is None:
+            pubmed_semaphore = asyncio.Semaphore(app.config['PUBMED_MAX_CONCURRENCY'])
+        return pubmed_semaphore
+
+    async def wait_for_pubmed_rate_limit():
+        """Spaces out PubMed requests so that no more than PUBMED_MAX_REQUESTS_PER_SECOND start each second."""
+        nonlocal pubmed_next_request
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # Everything runs on the one shared loop, so reserving the slot needs no lock
+        start = max(now, pubmed_next_request)
+        pubmed_next_request = start + 1 / app.config['PUBMED_MAX_REQUESTS_PER_SECOND']
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def fetch_pubmed_search(session, semaphore, params):
+        """Runs an ESearch request, retrying rate-limit/server errors and dropped connections with exponential backoff."""
+        retries = app.config['PUBMED_MAX_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                async with semaphore:
+                    await wait_for_pubmed_rate_limit()
+                    async with session.get("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi", params=params) as response:
+                        if response.status not in PUBMED_RETRY_STATUSES or attempt == retries:
+                            response.raise_for_status()
+                            return orjson.loads(await response.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+            # Back off outside the semaphore so other drugs can use the slot meanwhile
+            await asyncio.sleep(PUBMED_RETRY_BACKOFF * 2 ** attempt)
+
+    async def query_pubmed(session, semaphore, drug_name, disease):
         if not drug_name or not disease: return []
+        cache_key = (drug_name.lower(), disease.lower())
+        with pubmed_cache_lock:
+            links = pubmed_cache.get(cache_key)
+        if links is None:
+            links = pubmed_disk_cache.get(cache_key)
+            if links is not None:
+                with pubmed_cache_lock:
+                    pubmed_cache[cache_key] = links
+        if links is not None:
+            return links
+
         term = f'({drug_name}[Title/Abstract]) AND ({disease}[Title/Abstract]) AND (randomized controlled trial[Publication Type] OR meta-analysis[Publication Type] OR systematic review[Publication Type])'
         params = {'db': 'pubmed', 'term': term, 'retmode': 'json', 'retmax': 3, 'tool': app.config['PUBMED_API_TOOL'], 'email': app.config['PUBMED_API_EMAIL'], 'api_key': app.config['PUBMED_API_KEY']}
+        # Unlike requests, aiohttp does not silently drop None values
+        params = {k: v for k, v in params.items() if v is not None}
         try:
-            response = requests.get("https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi", params=params)
-            response.raise_for_status()
-            pmids = response.json().get('esearchresult', {}).get('idlist', [])
-            return [f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/" for pmid in pmids]
-        except requests.RequestException as e:
+            data = await fetch_pubmed_search(session, semaphore, params)
+            pmids = data.get('esearchresult', {}).get('idlist', [])
+            links = [f"https://pubmed.ncbi.nlm.nih.gov/{pmid}/" for pmid in pmids]
+            with pubmed_cache_lock:
+                pubmed_cache[cache_key] = links
+            pubmed_disk_cache.set(cache_key, links, expire=app.config['PUBMED_CACHE_TTL'])
+            return links
+        except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
             print(f"PubMed API request failed: {e}")
             return []
 
+    async def analyze_drug(session, semaphores, raw_drug, disease_context, details=None):
+        """Gets AI details for a single drug (unless already known), then queries PubMed with the AI-provided English name."""
+        if details is None:
+            try:
+                details = await ai_processor.get_drug_details_async(raw_drug.get('inn_protocol'), raw_drug.get('usage_protocol'), disease_context, semaphores['gemini'])
+            except AIProcessorException as e:
+                # A single failed drug should not abort the whole analysis
+                print(f"Drug details failed: {e}")
+        if not details:
+            details = {} # Ensure details is a dict to avoid errors on .get()
+
+        pubmed_links = await query_pubmed(session, semaphores['pubmed'], details.get('inn_english'), disease_context)
+        return details, pubmed_links
+
+    async def analyze_drug_batch(session, semaphores, batch, disease_context):
+        """Gets AI details for a batch of drugs with one call, then finishes each drug via analyze_drug."""
+        drug_tuples = [(d.get('inn_protocol'), d.get('usage_protocol')) for d in batch]
+        try:
+            batch_details = await ai_processor.get_drug_details_batch_async(drug_tuples, disease_context, semaphores['gemini'])
+        except AIProcessorException as e:
+            print(f"Batch drug details failed, falling back to single-drug calls: {e}")
+            batch_details = [None] * len(batch)
+        return await asyncio.gather(*(analyze_drug(session, semaphores, d, disease_context, details) for d, details in zip(batch, batch_details)))
+
+    async def analyze_all_drugs(drug_list, disease_context):
+        """Runs all drug batches concurrently, sharing one HTTP session; results keep input order."""
+        # Separate limits, both shared by all analyses: Gemini is bound by its QPM quota, PubMed by the NCBI rate limit
+        semaphores = {
+            'gemini': ai_processor.gemini_semaphore(),
+            'pubmed': get_pubmed_semaphore(),
+        }
+        batch_size = app.config['GEMINI_BATCH_SIZE']
+        batches = [drug_list[i:i + batch_size] for i in range(0, len(drug_list), batch_size)]
+        session = get_http_session()
+        batch_results = await asyncio.gather(*(analyze_drug_batch(session, semaphores, b, disease_context) for b in batches))
+        return [result for batch in batch_results for result in batch]
+
     # --- New AI-Powered Analysis Pipeline ---
-    def run_full_analysis(filepath, analysis_record):
+    def run_full_analysis(docx_file, analysis_record):
         # Step 1: Extract full text from document
-        full_text = get_full_text_from_docx(filepath)
+        full_text = get_full_text_from_docx(docx_file)
         if not full_text:
             raise ValueError("Не удалось извлечь текст из документа.")
 
@@ -70,25 +252,23 @@ def create_app(config_class=Config):
         disease_context = initial_analysis['disease_context']
         raw_drug_list = initial_analysis['drug_list']
 
-        # Step 3: Loop through drugs for detailed analysis
-        for raw_drug in raw_drug_list:
+        # Step 3: Detailed analysis (AI details + PubMed) for all distinct drugs at once.
+        # Protocols often repeat a drug in several rows, so duplicates share one result.
+        drug_list = [d for d in raw_drug_list if d.get('inn_protocol')]
+        unique_drugs = {}
+        for raw_drug in drug_list:
+            unique_drugs.setdefault(ai_processor.normalized_drug_key(raw_drug), raw_drug)
+        drug_analyses = dict(zip(unique_drugs, ai_processor.run_async(analyze_all_drugs(list(unique_drugs.values()), disease_context))))
+
+        rows = []
+        for raw_drug in drug_list:
+            details, pubmed_links = drug_analyses[ai_processor.normalized_drug_key(raw_drug)]
             inn_protocol = raw_drug.get('inn_protocol')
             usage_protocol = raw_drug.get('usage_protocol')
             loe_protocol = raw_drug.get('loe_protocol')
 
-            if not inn_protocol:
-                continue
-
-            # Second AI call for details
-            details = ai_processor.get_drug_details(inn_protocol, usage_protocol, disease_context)
-            if not details:
-                details = {} # Ensure details is a dict to avoid errors on .get()
-
-            # Query PubMed with AI-provided English name
-            pubmed_links = query_pubmed(details.get('inn_english'), disease_context)
-
-            # Create and save the final DrugResult object
-            drug_result = DrugResult(
+            # Create the final DrugResult object
+            rows.append(DrugResult(
                 analysis_id=analysis_record.id,
                 inn_protocol=inn_protocol,
                 usage_protocol=usage_protocol,
@@ -98,9 +278,10 @@ def create_app(config_class=Config):
                 system_loe=details.get('system_loe', 'Unknown'),
                 pubmed_links="\n".join(pubmed_links)
                 # Old fields are no longer populated by this pipeline
-            )
-            db.session.add(drug_result)
+            ))
 
+        # Save all rows with a single bulk insert
+        db.session.bulk_save_objects(rows)
         db.session.commit()
         return analysis_record.id
 
@@ -124,10 +305,12 @@ def create_app(config_class=Config):
                 new_analysis = Analysis(filename=filename)
                 db.session.add(new_analysis)
                 db.session.commit()
+                # Analyze the upload from memory; the copy kept for audit is written in the background
+                data = file.read()
                 filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{new_analysis.id}_{filename}")
-                file.save(filepath)
+                threading.Thread(target=save_upload, args=(filepath, data), daemon=True).start()
 
-                analysis_id = run_full_analysis(filepath, new_analysis)
+                analysis_id = run_full_analysis(io.BytesIO(data), new_analysis)
 
                 flash('Анализ успешно завершен!', 'success')
                 return redirect(url_for('analysis_detail', analysis_id=analysis_id))
@@ -153,31 +336,26 @@ def create_app(config_class=Config):
 
     @app.route('/analysis/<int:analysis_id>')
     def analysis_detail(analysis_id):
-        analysis = Analysis.query.get_or_404(analysis_id)
+        # The template renders every drug, so load them together with the analysis
+        analysis = Analysis.query.options(selectinload(Analysis.drug_results)).get_or_404(analysis_id)
         return render_template('analysis_detail.html', analysis=analysis)
 
     @app.route('/export/<int:analysis_id>')
     def export_results(analysis_id):
         analysis = Analysis.query.get_or_404(analysis_id)
-        document = docx.Document()
-        document.add_heading(f'Результаты Анализа: {analysis.filename}', 0)
-        headers = ['Название (из протокола)', 'МНН (ENG)', 'Краткое описание', 'Ссылки PubMed', 'УД (из протокола)', 'Системный УД']
-        table = document.add_table(rows=1, cols=len(headers))
-        table.style = 'Table Grid'
-        for i, header in enumerate(headers):
-            table.cell(0, i).text = header
-        for drug in analysis.drug_results:
-            row_cells = table.add_row().cells
-            row_cells[0].text = drug.inn_protocol or ''
-            row_cells[1].text = drug.inn_english or ''
-            row_cells[2].text = drug.brief_description or ''
-            row_cells[3].text = drug.pubmed_links if drug.pubmed_links else "Нет"
-            row_cells[4].text = drug.loe_protocol or ''
-            row_cells[5].text = drug.system_loe or ''
-        file_stream = io.BytesIO()
-        document.save(file_stream)
-        file_stream.seek(0)
-        return send_file(file_stream, as_attachment=True, download_name=f'report_{analysis.id}.docx', mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+        # The row count is part of the key: the Analysis row exists (and is linked from /history)
+        # before run_full_analysis commits its drug rows, so an early export must not be reused.
+        # COUNT(*) avoids loading every row when the report is served from the cache.
+        drug_count = DrugResult.query.filter_by(analysis_id=analysis.id).count()
+        key = f"{analysis.id}_{analysis.upload_timestamp.timestamp()}_{drug_count}"
+        report = export_cache.get(key)
+        if report is None:
+            report = report_exporter.build_report(analysis)
+            export_cache.set(key, report)
+        file_stream = io.BytesIO(report)
+        # The ETag lets browsers revalidate with If-None-Match and get a 304 instead of the file
+        return send_file(file_stream, as_attachment=True, download_name=f'report_{analysis.id}.docx', mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+                         etag=key, conditional=True)
 
     return app
 
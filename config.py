@@ -16,9 +16,24 @@ class Config:
     PUBMED_API_KEY = os.getenv('PUBMED_API_KEY')
     PUBMED_API_TOOL = 'Protocol-Analyzer'
     PUBMED_API_EMAIL = os.getenv('PUBMED_API_EMAIL')
+    # How long PubMed search results are cached (seconds)
+    PUBMED_CACHE_TTL = 24 * 3600
+    # Max number of PubMed requests in flight at once, across all analyses
+    PUBMED_MAX_CONCURRENCY = 10
+    # Max number of PubMed requests started per second, across all analyses (NCBI allows 10/s with an API key, 3/s without)
+    PUBMED_MAX_REQUESTS_PER_SECOND = 10 if PUBMED_API_KEY else 3
+    # Per-request timeout (seconds) and retry count for PubMed calls
+    PUBMED_TIMEOUT = 10
+    PUBMED_MAX_RETRIES = 3
+    # Size of the keep-alive connection pool shared by all outgoing HTTP calls of the app
+    HTTP_POOL_SIZE = 32
 
     # Gemini API Key
     GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+    # Max number of concurrent Gemini requests (keeps us under the QPM limit)
+    GEMINI_MAX_CONCURRENCY = 20
+    # Number of drugs whose details are requested in a single Gemini call
+    GEMINI_BATCH_SIZE = 10
 
     # File Upload Settings
     # Note: app.instance_path is the absolute path to the instance folder.
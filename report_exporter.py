@@ -0,0 +1,82 @@
+import io
+import re
+import zipfile
+import functools
+import docx
+from xml.sax.saxutils import escape
+from jinja2 import Environment
+
+# Column headers of the exported results table
+REPORT_HEADERS = ['Название (из протокола)', 'МНН (ENG)', 'Краткое описание', 'Ссылки PubMed', 'УД (из протокола)', 'Системный УД']
+
+DOCUMENT_XML = 'word/document.xml'
+# Text width of the default python-docx page (12240 twips minus two 1800 twips margins)
+TEXT_WIDTH = 8640
+
+# Characters that are not allowed in XML 1.0 and would corrupt the document
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def _wtext(value):
+    """Escapes text for a <w:t> element, turning newlines into line breaks like python-docx does."""
+    text = escape(_INVALID_XML_CHARS.sub('', value or ''))
+    return text.replace('\n', '</w:t><w:br/><w:t xml:space="preserve">')
+
+_environment = Environment(autoescape=False)
+_environment.filters['wtext'] = _wtext
+
+# Body of word/document.xml: a "Title" heading followed by a "Table Grid" table.
+# Every user-provided value goes through the wtext filter.
+_BODY_TEMPLATE = _environment.from_string(
+    '<w:p><w:pPr><w:pStyle w:val="Title"/></w:pPr><w:r><w:t xml:space="preserve">{{ title|wtext }}</w:t></w:r></w:p>'
+    '<w:tbl>'
+    '<w:tblPr><w:tblStyle w:val="TableGrid"/><w:tblW w:type="auto" w:w="0"/>'
+    '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" w:noVBand="1" w:val="04A0"/></w:tblPr>'
+    '<w:tblGrid>{% for _ in rows[0] %}<w:gridCol w:w="{{ col_width }}"/>{% endfor %}</w:tblGrid>'
+    '{% for row in rows %}<w:tr>{% for cell in row %}'
+    '<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{{ col_width }}"/></w:tcPr>'
+    '<w:p><w:r><w:t xml:space="preserve">{{ cell|wtext }}</w:t></w:r></w:p></w:tc>'
+    '{% endfor %}</w:tr>{% endfor %}'
+    '</w:tbl>'
+)
+
+@functools.lru_cache(maxsize=1)
+def _load_template():
+    """
+    Loads the default python-docx package once and splits its document.xml around the body content.
+    Returns (parts, prefix, suffix) where parts maps zip entry names to their bytes.
+    """
+    buffer = io.BytesIO()
+    docx.Document().save(buffer)
+    with zipfile.ZipFile(buffer) as archive:
+        parts = {name: archive.read(name) for name in archive.namelist()}
+    document_xml = parts[DOCUMENT_XML].decode('utf-8')
+    body_start = document_xml.index('<w:body>') + len('<w:body>')
+    body_end = document_xml.index('<w:sectPr', body_start)
+    return parts, document_xml[:body_start], document_xml[body_end:]
+
+def build_report(analysis):
+    """Renders the analysis results as a .docx file and returns its bytes."""
+    parts, prefix, suffix = _load_template()
+    rows = [REPORT_HEADERS]
+    for drug in analysis.drug_results:
+        rows.append([
+            drug.inn_protocol,
+            drug.inn_english,
+            drug.brief_description,
+            drug.pubmed_links if drug.pubmed_links else "Нет",
+            drug.loe_protocol,
+            drug.system_loe,
+        ])
+    body = _BODY_TEMPLATE.render(
+        title=f'Результаты Анализа: {analysis.filename}',
+        rows=rows,
+        col_width=TEXT_WIDTH // len(REPORT_HEADERS),
+    )
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in parts.items():
+            if name == DOCUMENT_XML:
+                data = (prefix + body + suffix).encode('utf-8')
+            archive.writestr(name, data)
+    return buffer.getvalue()